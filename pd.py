@@ -18,6 +18,7 @@
 ##
 
 
+import struct
 import sigrokdecode as srd
 
 # Dictionary of FUNCTION commands and their names.
@@ -31,25 +32,98 @@ commands_1977 = {
 }
 
 
-# Calculate the CRC-16 checksum.
-# Initial value: 0x0000, xor-in: 0x0000, polynom 0x8005, xor-out: 0xffff.
-def crc16(byte_array):
+# Byte-wise lookup table for the reflected CRC-16 (polynom 0x8005).
+# Entry b is the CRC register after shifting byte b through with crc = 0,
+# which is the same as starting with crc = b and shifting eight zero bits.
+def _crc16_table():
     reverse = 0xa001  # Use the reverse polynom to make algo simpler.
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = (crc >> 1) ^ reverse if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+_CRC16_TABLE = _crc16_table()
+_U16LE = struct.Struct('<H')
+
+
+def _crc16_py(byte_array):
     crc = 0x0000  # Initial value.
-    # Reverse CRC calculation.
+    tbl = _CRC16_TABLE
+    # Reverse CRC calculation, one byte per table lookup.
     for byte in byte_array:
-        for bit in range(8):
-            if (byte ^ crc) & 1:
-                crc = (crc >> 1) ^ reverse
-            else:
-                crc >>= 1
-            byte >>= 1
-    crc ^= 0xffff  # Invert CRC.
-    return crc
+        crc = (crc >> 8) ^ tbl[(crc ^ byte) & 0xff]
+    return crc ^ 0xffff  # Invert CRC.
+
+
+# Same loop as _crc16_py(), compiled with Numba on first use of crc16().
+def _crc16_kernel(arr, tbl):
+    crc = 0x0000
+    for byte in arr:
+        crc = (crc >> 8) ^ tbl[(crc ^ byte) & 0xff]
+    return crc ^ 0xffff
+
+
+# Numba is optional and only imported when crc16() first needs it, so
+# loading the decoder does not pay for it. False if unavailable or if the
+# kernel fails to compile.
+_CRC16_NB_MIN = 64
+_crc16_nb = None
+
+
+def _load_crc16_nb():
+    global _crc16_nb
+    try:
+        import numpy as np
+        from numba import njit
+        kernel = njit(cache=True)(_crc16_kernel)
+        tbl = np.array(_CRC16_TABLE, dtype=np.uint16)
+        # Compile (or load from cache) now, so a Numba failure also falls
+        # back to the pure Python version.
+        check = b'123456789'
+        if kernel(np.frombuffer(check, dtype=np.uint8), tbl) != _crc16_py(check):
+            raise ValueError('Numba CRC-16 kernel mismatch')
+    except Exception:
+        _crc16_nb = False
+        return
+
+    def crc16_nb(byte_array):
+        arr = np.frombuffer(bytes(byte_array), dtype=np.uint8)
+        return int(kernel(arr, tbl))
+    _crc16_nb = crc16_nb
+
+
+# Calculate the CRC-16 checksum.
+# Initial value: 0x0000, xor-in: 0x0000, polynom 0x8005, xor-out: 0xffff.
+def crc16(byte_array):
+    # Short buffers stay in Python, where numpy conversion would dominate.
+    if len(byte_array) >= _CRC16_NB_MIN:
+        if _crc16_nb is None:
+            _load_crc16_nb()
+        if _crc16_nb:
+            return _crc16_nb(byte_array)
+    return _crc16_py(byte_array)
 
 
 bin_mem, bin_read, bin_full = range(3)
-ann_data, ann_reset, ann_rom, ann_cmd, ann_pwd, ann_addr, ann_end, ann_stat, ann_crc, ann_succ, ann_fail, ann_err = range(12)
+ann_data, ann_reset, ann_rom, ann_cmd, ann_pwd, ann_addr, ann_end, ann_stat, ann_crc, ann_succ, ann_fail, ann_err, ann_byte = range(13)
+
+# Constant annotation payloads.
+_RESET_TRUE = [ann_reset, ['Reset/Presence: true']]
+_RESET_FALSE = [ann_reset, ['Reset/Presence: false']]
+_ANN_SUCC = [ann_succ, ['Operation Succeeded', 'Success', 'S']]
+_ANN_FAIL = [ann_fail, ['Operation Failed', 'Failed', 'F']]
+_ANN_OK = [ann_stat, ['Data status: OK']]
+_ANN_ERR = [ann_stat, ['Data status: Err']]
+
+# Data status of the E/S byte, indexed by whether any of bits 7:6 are set.
+_STATUS = (_ANN_OK, _ANN_ERR)
+
+# Per-byte data annotations, indexed by byte value.
+_BYTE_ANNS = tuple([ann_byte, ['%02x' % b]] for b in range(256))
 
 
 class Decoder(srd.Decoder):
@@ -75,10 +149,13 @@ class Decoder(srd.Decoder):
         ('succ', 'Success'),
         ('fail', 'Fail'),
         ('err', 'Error'),
+        ('byte', 'Data Byte'),
     )
-    annotations_row = (
-        ('bits', 'Bits', (ann_data, ann_reset, ann_rom, ann_cmd, ann_pwd, ann_addr, ann_crc, ann_succ, ann_fail)),
-        ('err', 'Error', (ann_err)),
+    annotation_rows = (
+        ('bits', 'Bits', (ann_data, ann_reset, ann_rom, ann_cmd, ann_pwd, ann_addr,
+                          ann_end, ann_stat, ann_crc, ann_succ, ann_fail)),
+        ('err', 'Error', (ann_err,)),
+        ('bytes', 'Bytes', (ann_byte,)),
     )
 
     binary = (
@@ -92,28 +169,105 @@ class Decoder(srd.Decoder):
 
     def reset(self):
         # Bytes for function command.
-        self.bytes = []
+        self.bytes = bytearray()
         self.family_code = None
         self.family = 'DS1977'
         self.commands = commands_1977
+        # Per-length steps and data offset of the current function command.
+        self._cmd_steps = None
+        self._cmd_data = None
+        # Data phase of the current frame: offset of first data byte and ss/es
+        # of the 'Data(N)' summary emitted when the frame ends.
+        self._data_k = None
+        self._data_ss = self._data_es = None
 
     def start(self):
         self.out_ann = self.register(srd.OUTPUT_ANN)
         self.out_binary = self.register(srd.OUTPUT_BINARY)
+        # Function command steps, keyed by command byte: actions keyed by the
+        # number of bytes received so far, and the offset of the trailing
+        # data bytes (None if the command has no data phase).
+        set_ss, put_addr = self._set_ss, self._put_addr
+        self._steps = {
+            # Write scratchpad
+            0x0f: ({2: set_ss, 3: put_addr}, 3),
+            # Read scratchpad
+            0xaa: ({2: set_ss, 3: put_addr, 4: self._put_end_stat}, 4),
+            # Copy Scratchpad with Password
+            0x99: ({2: set_ss, 4: self._put_auth, 5: set_ss,
+                    12: self._put_full_pwd, 13: self._put_result}, None),
+            # Read Memory with Password
+            0x69: ({2: set_ss, 3: put_addr, 4: set_ss, 11: self._put_read_pwd}, 11),
+        }
+        # Command annotations, keyed by command byte.
+        self._cmd_anns = {c: [ann_cmd, names] for c, names in self.commands.items()}
+
+    def _put_data(self, k, ss, es, val):
+        if self._data_k is None:
+            self._data_k, self._data_ss = k, ss
+        self._data_es = es
+        self.put(ss, es, self.out_ann, _BYTE_ANNS[val])
+
+    def _flush_data(self):
+        k = self._data_k
+        if k is None:
+            return
+        bytes_ = self.bytes
+        self.put(self._data_ss, self._data_es, self.out_ann,
+                 [ann_data, ['Data(%d): ' % (len(bytes_)-k) + bytes_[k:].hex(' ')]])
+
+    def _end_frame(self):
+        self._flush_data()
+        self._data_k = None
+        self.bytes = bytearray()
+
+    def end(self):
+        # End of stream (only called by libsigrokdecode versions that support
+        # it): emit the summary of a frame without a trailing reset.
+        self._end_frame()
+
+    def _set_ss(self, ss, es, val):
+        self.ss = ss
+
+    def _put_addr(self, ss, es, val):
+        addr = _U16LE.unpack_from(self.bytes, 1)[0]
+        self.put(self.ss, es, self.out_ann, [ann_addr, [f'Target address: 0x{addr:04x}']])
+
+    def _put_end_stat(self, ss, es, val):
+        put, out_ann = self.put, self.out_ann
+        tmp = ss + (es - ss) // 4 * 3
+        put(ss, tmp, out_ann, [ann_end, ['Ending Offset: %d' % (val & 0x3f)]])
+        put(tmp, es, out_ann, _STATUS[(val >> 6) != 0])
+
+    def _put_auth(self, ss, es, val):
+        self.put(self.ss, es, self.out_ann,
+                 [0, ['Authorization pattern (TA1, TA2, E/S): '
+                      + (', '.join(format(b, '#04x') for b in self.bytes[1:4]))]])
+
+    def _put_full_pwd(self, ss, es, val):
+        self.put(self.ss, es, self.out_ann,
+                 [ann_pwd, ['Full Access Password: ' + self.bytes[4:].hex(' ')]])
+        # self.put(ss, es, self.out_binary, [bin_full, bytes(self.bytes[4:])])
+
+    def _put_result(self, ss, es, val):
+        if 0xaa == val or 0x55 == val:
+            self.put(ss, es, self.out_ann, _ANN_SUCC)
+        else:
+            self.put(ss, es, self.out_ann, _ANN_FAIL)
 
-    def putx(self, data):
-        self.put(self.ss, self.es, self.out_ann, data)
+    def _put_read_pwd(self, ss, es, val):
+        self.put(self.ss, es, self.out_ann,
+                 [ann_pwd, ['Read Access Password: ' + self.bytes[3:].hex(' ')]])
 
     def decode(self, ss, es, data):
         code, val = data
+        put, out_ann = self.put, self.out_ann
 
         if code == 'RESET/PRESENCE':
-            self.ss, self.es = ss, es
-            self.putx([ann_reset, ['Reset/Presence: %s'
-                                   % ('true' if val else 'false')]])
-            self.bytes = []
+            self._end_frame()
+            put(ss, es, out_ann, _RESET_TRUE if val else _RESET_FALSE)
         elif code == 'ROM':
-            self.ss, self.es = ss, es
+            self._end_frame()
             self.family_code = val & 0xff
 
             s = None
@@ -122,85 +276,25 @@ class Decoder(srd.Decoder):
             else:
                 s = '0x%02x unknown' % (self.family_code)
 
-            self.putx([ann_rom, ['ROM: 0x%016x (%s)' % (val, 'family code ' + s),
-                                 'ROM: 0x%016x (%s)' % (val, self.family),
-                                 'ROM: 0x%016x' % val]])
-            self.bytes = []
+            put(ss, es, out_ann, [ann_rom, ['ROM: 0x%016x (%s)' % (val, 'family code ' + s),
+                                            'ROM: 0x%016x (%s)' % (val, self.family),
+                                            'ROM: 0x%016x' % val]])
         elif code == 'DATA':
-            self.bytes.append(val)
-            if 1 == len(self.bytes):
-                self.ss, self.es = ss, es
-                if val not in self.commands:
-                    self.putx([ann_err, ['Unrecognized command: 0x%02x' % val]])
+            bytes_ = self.bytes
+            bytes_.append(val)
+            n = len(bytes_)
+            if 1 == n:
+                self.ss = ss
+                self._cmd_steps, self._cmd_data = self._steps.get(val, (None, None))
+                cmd_ann = self._cmd_anns.get(val)
+                if cmd_ann is None:
+                    put(ss, es, out_ann, [ann_err, ['Unrecognized command: 0x%02x' % val]])
                 else:
-                    self.putx([ann_cmd, self.commands[val]])
-            elif 0x0f == self.bytes[0]:  # Write scratchpad
-                if 2 == len(self.bytes):
-                    self.ss = ss
-                elif 3 == len(self.bytes):
-                    self.es = es
-                    self.putx([ann_addr, ['Target address: 0x%04x'
-                                          % ((self.bytes[2] << 8) + self.bytes[1])]])
-                elif 4 == len(self.bytes):
-                    self.ss = ss
-                if 4 <= len(self.bytes):
-                    self.es = es
-                    self.putx([ann_data, ['Data(%d): ' % (len(self.bytes)-3) + (' '.join(format(n, '02x')
-                                          for n in self.bytes[3:]))]])
-            elif 0xaa == self.bytes[0]:  # Read scratchpad
-                if 2 == len(self.bytes):
-                    self.ss = ss
-                elif 3 == len(self.bytes):
-                    self.es = es
-                    self.putx([ann_addr, ['Target address: 0x%04x'
-                                          % ((self.bytes[2] << 8) + self.bytes[1])]])
-                elif 4 == len(self.bytes):
-                    tmp = ss + int((es-ss)/4) * 3
-                    self.ss, self.es = ss, tmp
-                    self.putx([ann_end, ['Ending Offset: %d' % (self.bytes[3] & 0x3f)]])
-                    self.ss, self.es = tmp, es
-                    self.putx([ann_stat, ['Data status: %s' % ('OK' if (self.bytes[3] & 0xc0 == 0) else 'Err')]])
-                elif 5 == len(self.bytes):
-                    self.ss = ss
-                if 5 <= len(self.bytes):
-                    self.es = es
-                    self.putx([0, ['Data(%d): ' % (len(self.bytes)-4) + (' '.join(format(n, '02x')
-                                   for n in self.bytes[4:]))]])
-            elif 0x99 == self.bytes[0]:  # Copy Scratchpad with Password
-                if 2 == len(self.bytes):
-                    self.ss = ss
-                elif 4 == len(self.bytes):
-                    self.es = es
-                    self.putx([0, ['Authorization pattern (TA1, TA2, E/S): '
-                                   + (', '.join(format(n, '#04x') for n in self.bytes[1:4]))]])
-                elif 5 == len(self.bytes):
-                    self.ss = ss
-                elif 12 == len(self.bytes):
-                    self.es = es
-                    self.putx([ann_pwd, ['Full Access Password: '
-                                         + (' '.join(format(n, '02x') for n in self.bytes[4:]))]])
-                    # self.put(ss, es, self.out_binary, [bin_full, bytes(self.bytes[4:])])
-                elif 13 == len(self.bytes):
-                    self.ss, self.es = ss, es
-                    if 0xaa == self.bytes[-1] or 0x55 == self.bytes[-1]:
-                        self.putx([ann_succ, ['Operation Succeeded', 'Success', 'S']])
-                    else:
-                        self.putx([ann_fail, ['Operation Failed', 'Failed', 'F']])
-            elif 0x69 == self.bytes[0]:  # Read Memory with Password
-                if 2 == len(self.bytes):
-                    self.ss = ss
-                elif 3 == len(self.bytes):
-                    self.es = es
-                    self.putx([ann_addr, ['Target address: 0x%04x' % ((self.bytes[2] << 8) + self.bytes[1])]])
-                elif 4 == len(self.bytes):
-                    self.ss = ss
-                elif 11 == len(self.bytes):
-                    self.es = es
-                    self.putx([ann_pwd, ['Read Access Password: ' + (' '.join(format(n, '02x')
-                                         for n in self.bytes[3:]))]])
-                elif 12 == len(self.bytes):
-                    self.ss = ss
-                if 12 <= len(self.bytes):
-                    self.es = es
-                    self.putx([ann_data, ['Data(%d): ' % (len(self.bytes)-11) + (' '.join(format(n, '02x')
-                                          for n in self.bytes[11:]))]])
+                    put(ss, es, out_ann, cmd_ann)
+            elif self._cmd_steps is not None:
+                step = self._cmd_steps.get(n)
+                if step is not None:
+                    step(ss, es, val)
+                k = self._cmd_data
+                if k is not None and n > k:
+                    self._put_data(k, ss, es, val)